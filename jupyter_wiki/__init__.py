@@ -4,10 +4,15 @@
 
 def _jupyter_nbextension_paths():
     return [dict(
-        section="notebook",
-        src="static",
-        dest="jupyter_wiki",
-        require="jupyter_wiki/main")]
+                section="notebook",
+                src="static",
+                dest="jupyter_wiki",
+                require="jupyter_wiki/main"),
+            dict(
+                section="tree",
+                src="static",
+                dest="jupyter_wiki",
+                require="jupyter_wiki/tree")]
 
 def _jupyter_server_extension_paths():
     return [{"module":"jupyter_wiki.server_extension"}]
@@ -7,17 +7,80 @@ from notebook.base.handlers import IPythonHandler, FilesRedirectHandler, path_re
 from tornado import web
 import json
 import xattr
+import re
+import html
+import requests
+import configparser
 
+#===============================================================================
+class WikifsError(Exception):
+    pass
+
+#===============================================================================
+def wikifs_request(action, params, json=None):
+    """Talks directly to the wikifs server, using the same config as the FUSE
+    client. The config file is given by the environment variable WIKIFS_CONFIG."""
+    config = configparser.ConfigParser()
+    config.read(os.environ.get("WIKIFS_CONFIG", "wiki.cfg"))
+    url = config['wikifs']["server_url"] + "/" + action
+    headers = {"Wikifs-Authorization": config['wikifs']["auth_token"]}
+    timeout = config['wikifs'].getfloat("timeout", 30) # never block the notebook server
+    if json==None:
+        resp = requests.get(url, params=params, headers=headers, timeout=timeout)
+    else:
+        resp = requests.post(url, params=params, headers=headers, json=json, timeout=timeout)
+
+    if resp.status_code != 200: # Ok
+        # pass on the server's error message, like WikiFS._request does
+        m = re.search("<p>([^<]*)</p>", resp.text)
+        if m:
+            raise WikifsError(html.unescape(m.group(1)))
+        raise WikifsError("Something went wrong")
+    return resp.json()
+
+#===============================================================================
+def mount_point(cm):
+    """The FUSE mount point is given by the environment variable WIKIFS_MOUNT,
+    it defaults to the notebook directory."""
+    return os.path.abspath(os.environ.get("WIKIFS_MOUNT", cm.root_dir))
+
+#===============================================================================
+def relative_path(full_path, base):
+    rel_path = os.path.relpath(full_path, base)
+    if rel_path == os.pardir or rel_path.startswith(os.pardir + os.sep):
+        return None # outside of base
+    if rel_path == os.curdir:
+        return ""
+    return rel_path.replace(os.sep, "/")
+
+#===============================================================================
+def to_wiki_path(cm, path):
+    """Maps a contents path onto a wiki path, or None if outside the mount."""
+    full_path = os.path.abspath(cm._get_os_path(path))
+    rel_path = relative_path(full_path, mount_point(cm))
+    if rel_path is None:
+        return None
+    return "/" + rel_path
+
+#===============================================================================
+def to_contents_path(cm, wiki_path):
+    """Maps a wiki path onto a contents path, or None if outside the root."""
+    full_path = os.path.join(mount_point(cm), wiki_path.lstrip("/"))
+    return relative_path(full_path, os.path.abspath(cm.root_dir))
+
+#===============================================================================
 class AppmodeHandler(IPythonHandler):
     #===========================================================================
     @web.authenticated
     def post(self):
-        """get renders the notebook template if a name is given, or 
-        redirects to the '/files/' handler if the name is not given."""
+        """Performs lock actions on wiki pages. Takes either a single action
+        and path, or a list of them under the key 'actions'."""
 
-        #path = path.strip('/')
-        #self.log.info('Wiki get: %s', path)
         data = self.get_json_body()
+        if 'actions' in data:
+            self.finish(json.dumps(self.batch(data['actions'])))
+            return
+
         action = data['action']
         path = data['path']
         cm = self.contents_manager
@@ -26,24 +89,90 @@ class AppmodeHandler(IPythonHandler):
         try:
             if action == "aquire_lock":
                 os.chmod(full_path, 0o100664) # '-rw-rw-r--'
-                self.finish(json.dumps({"success": True, "message": ""}))
             elif action == "release_lock":
                 os.chmod(full_path, 0o100444) # '-r--r--r--'
-                self.finish(json.dumps({"success": True, "message": ""}))
-            else:
+            elif action != "status":
                 err_msg = "Unknown action "+action
                 self.finish(json.dumps({"success": False, "message": err_msg}))
+                return
+            writable = bool(os.stat(full_path).st_mode & 0o000222)  # '?-w--w--w-'
+            self.finish(json.dumps({"success": True, "message": "", "writable": writable}))
             return
         except:
             pass
 
         # Ok, something went wrong let's try to retrieve an error message
         try:
-            err_msg = xattr.getxattr(full_path, "wikifs_error")
+            err_msg = xattr.getxattr(full_path, "wikifs_error").decode("utf-8")
         except:
             err_msg = "Something went wrong"
 
         self.finish(json.dumps({"success": False, "message": err_msg}))
+
+    #===========================================================================
+    def batch(self, actions):
+        # bypasses the FUSE mount, such that all actions go into one request
+        cm = self.contents_manager
+        wiki_actions = []
+        for a in actions:
+            wiki_path = to_wiki_path(cm, a['path'])
+            if wiki_path is None:
+                err_msg = "Path %s is outside of the wiki"%a['path']
+                return {"success": False, "message": err_msg, "results": []}
+            wiki_actions.append({"action":a['action'], "path":wiki_path})
+
+        try:
+            results = wikifs_request("batch", {}, json={"actions":wiki_actions})
+        except Exception as e:
+            return {"success": False, "message": str(e), "results": []}
+
+        for a, r in zip(actions, results):
+            r['path'] = a['path']
+            r['writable'] = r['lock_is_yours']
+        success = all(r['success'] for r in results)
+        message = "\n".join(r['message'] for r in results if r['message'])
+        return {"success": success, "message": message, "results": results}
+
+#===============================================================================
+class SearchHandler(IPythonHandler):
+    #===========================================================================
+    @web.authenticated
+    def get(self):
+        """full-text search over all published wiki pages"""
+        query = self.get_argument("q")
+        limit = self.get_argument("limit", "50")
+        try:
+            results = wikifs_request("search", {"q":query, "limit":limit})
+        except Exception as e:
+            self.finish(json.dumps({"success": False, "message": str(e)}))
+            return
+
+        # skip pages which are not reachable through the notebook directory
+        cm = self.contents_manager
+        for r in results:
+            r['path'] = to_contents_path(cm, r['path'])
+        results = [r for r in results if r['path'] is not None]
+        self.finish(json.dumps({"success": True, "results": results}))
+
+#===============================================================================
+class StatusHandler(IPythonHandler):
+    #===========================================================================
+    @web.authenticated
+    def get(self):
+        """lock status of all wiki pages within a directory"""
+        path = self.get_argument("path", "")
+        wiki_path = to_wiki_path(self.contents_manager, path)
+        if wiki_path is None:
+            err_msg = "Path %s is outside of the wiki"%path
+            self.finish(json.dumps({"success": False, "message": err_msg}))
+            return
+        try:
+            locks = wikifs_request("lockstatus", {"path":wiki_path})
+        except Exception as e:
+            self.finish(json.dumps({"success": False, "message": str(e)}))
+            return
+        self.finish(json.dumps({"success": True, "locks": locks}))
+
 #===============================================================================    
 def load_jupyter_server_extension(nbapp):
     #tmpl_dir = os.path.dirname(__file__)
@@ -56,7 +185,11 @@ def load_jupyter_server_extension(nbapp):
     web_app = nbapp.web_app
     host_pattern = '.*$'
     route_pattern = url_path_join(web_app.settings['base_url'], r'/api/wiki')
-    web_app.add_handlers(host_pattern, [(route_pattern, AppmodeHandler)])
+    search_pattern = url_path_join(web_app.settings['base_url'], r'/api/wiki/search')
+    status_pattern = url_path_join(web_app.settings['base_url'], r'/api/wiki/status')
+    web_app.add_handlers(host_pattern, [(route_pattern, AppmodeHandler),
+                                        (search_pattern, SearchHandler),
+                                        (status_pattern, StatusHandler)])
     nbapp.log.info("Wiki server extension loaded.")
 
 #EOF
\ No newline at end of file
@@ -70,7 +70,20 @@ define([
 
     //==========================================================================
     var on_wiki_publish = function () {
-        perform_action("release_lock");
+        if(!Jupyter.notebook.dirty){
+            perform_action("release_lock");
+            return;
+        }
+
+        // publish what the user sees, not what was last saved
+        Jupyter.notebook.save_notebook().then(
+            function () {
+                perform_action("release_lock");
+            },
+            function(error) {
+                show_message("Error", "Could not save notebook: " + error);
+            }
+        );
     };
 
     //==========================================================================
@@ -90,10 +103,15 @@ define([
         var future = utils.promising_ajax(url, settings);
         future.then(
             function (data) {
-                if(data['success']){
-                    location.reload();
-                }else{
+                if(!data['success']){
                     show_message("Error", data['message']);
+                }else if(data['writable'] && !Jupyter.notebook.writable){
+                    // page might have changed since it was loaded
+                    events.one('notebook_loaded.Notebook', setup_notebook);
+                    Jupyter.notebook.load_notebook(Jupyter.notebook.notebook_path);
+                }else{
+                    Jupyter.notebook.writable = data['writable'];
+                    setup_notebook();
                 }
             },
             function(error) {
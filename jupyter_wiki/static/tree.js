@@ -0,0 +1,63 @@
+// show lock status of wiki pages in the file browser
+
+define([
+    'jquery',
+    'base/js/namespace',
+    'base/js/events',
+    'base/js/utils',
+], function(
+    $,
+    Jupyter,
+    events,
+    utils
+) {
+    "use strict";
+
+    //==========================================================================
+    var decorate_tree = function () {
+        var notebook_list = Jupyter.notebook_list;
+        var path = notebook_list.notebook_path;
+        var url = utils.url_path_join(notebook_list.base_url, "api/wiki/status");
+        url += "?path=" + encodeURIComponent(path);
+
+        // one request for the entire directory
+        var future = utils.promising_ajax(url, {type: "GET", dataType: "json"});
+        future.then(
+            function (data) {
+                $(".jupyterwiki_lock").remove();
+                if(!data['success'])
+                    return;
+                $("#notebook_list .list_item").each(function() {
+                    var item = $(this);
+                    var status = data['locks'][item.data('name')];
+                    if(!status)
+                        return;
+                    var title = "Locked by " + status['locked_by'];
+                    var icon = "fa-lock";
+                    if(status['lock_is_yours']){
+                        title = "Locked by you";
+                        icon = "fa-pencil";
+                    }
+                    $('<i/>').addClass("fa jupyterwiki_lock " + icon)
+                        .attr('title', title)
+                        .css('margin-left', '0.5em')
+                        .insertAfter(item.find(".item_name"));
+                });
+            },
+            function(error) {
+                console.log("jupyterwiki: could not fetch lock status", error);
+            }
+        );
+    };
+
+    //==========================================================================
+    var load_ipython_extension = function() {
+        events.on('draw_notebook_list.NotebookList', decorate_tree);
+        decorate_tree();
+    };
+
+    //==========================================================================
+    return {
+        load_ipython_extension : load_ipython_extension
+    };
+});
@@ -7,7 +7,7 @@ import errno
 import os.path
 
 import logging
-from threading import Lock
+from threading import Lock, RLock
 from fuse import FUSE, FuseOSError, Operations, LoggingMixIn
 
 import requests
@@ -18,13 +18,146 @@ import tempfile
 import shutil
 import re
 
+#===============================================================================
+class MirrorStore(object):
+    """Temporary storage for mirrors of wiki files.
+    Small files are kept in memory, larger ones in a directory on disk.
+    A memory mirror which grows beyond the limit is moved to disk.
+    The quota applies to the combined size of all mirrors."""
+
+    def __init__(self, directory, quota, memory_limit):
+        self.directory = directory
+        self.quota = quota
+        self.memory_limit = memory_limit
+        self.lock = RLock()
+        self.sizes = {}
+        self.memfds = {}
+        self.handles = {}
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+            os.chmod(directory, 0o700) # mirrors are private, regardless of umask
+        if os.stat(directory).st_uid != os.getuid():
+            raise PermissionError(errno.EACCES, "Mirror directory owned by another user", directory)
+        self._cleanup()
+
+    #===========================================================================
+    def _cleanup(self):
+        # remove our own mirrors left behind by crashed processes
+        for fn in os.listdir(self.directory):
+            m = re.match(r"wikifs_(\d+)_", fn)
+            if not m:
+                continue
+            fn = os.path.join(self.directory, fn)
+            if os.lstat(fn).st_uid == os.getuid() and not self._pid_alive(int(m.group(1))):
+                print("removing orphaned mirror "+fn)
+                os.remove(fn)
+
+    #===========================================================================
+    def _pid_alive(self, pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass # process exists, but belongs to someone else
+        return True
+
+    #===========================================================================
+    def new(self, size):
+        with self.lock:
+            self._check_quota(None, size)
+            if size <= self.memory_limit and hasattr(os, "memfd_create"):
+                # memfd can be re-opened through procfs like a regular file
+                fd = os.memfd_create("wikifs_mirror")
+                tmp_fn = "/proc/self/fd/%d"%fd
+                self.memfds[tmp_fn] = fd
+            else:
+                tmp_fn = self._new_file()
+            self.sizes[tmp_fn] = size
+            self.handles[tmp_fn] = {}
+            return tmp_fn
+
+    #===========================================================================
+    def _new_file(self):
+        prefix = "wikifs_%d_"%os.getpid()
+        tmp_f, tmp_fn = tempfile.mkstemp(prefix=prefix, dir=self.directory)
+        os.close(tmp_f)
+        return tmp_fn
+
+    #===========================================================================
+    def _check_quota(self, tmp_fn, size):
+        others = sum(v for k, v in self.sizes.items() if k != tmp_fn)
+        if others + size > self.quota:
+            raise FuseOSError(errno.ENOSPC) # No space left on device
+
+    #===========================================================================
+    def open(self, tmp_fn, flags):
+        with self.lock:
+            fh = os.open(tmp_fn, flags)
+            self.handles[tmp_fn][fh] = flags & ~(os.O_CREAT | os.O_EXCL | os.O_TRUNC)
+            return fh
+
+    #===========================================================================
+    def close(self, tmp_fn, fh):
+        with self.lock:
+            self.handles[tmp_fn].pop(fh)
+            os.close(fh)
+
+    #===========================================================================
+    def resize(self, tmp_fn, size):
+        """Returns the mirror's file name, which changes when it moves to disk."""
+        with self.lock:
+            self._check_quota(tmp_fn, size)
+            self.sizes[tmp_fn] = size
+            if tmp_fn in self.memfds and size > self.memory_limit:
+                tmp_fn = self._spill(tmp_fn)
+            return tmp_fn
+
+    #===========================================================================
+    def grow(self, tmp_fn, size):
+        with self.lock:
+            return self.resize(tmp_fn, max(self.sizes[tmp_fn], size))
+
+    #===========================================================================
+    def _spill(self, mem_fn):
+        # move memory mirror to disk, including all its open file handles
+        disk_fn = self._new_file()
+        shutil.copyfile(mem_fn, disk_fn)
+        mode = os.stat(mem_fn).st_mode
+        os.chmod(disk_fn, 0o100600) # allow re-opening for writing
+        for fh, flags in self.handles[mem_fn].items():
+            offset = os.lseek(fh, 0, os.SEEK_CUR)
+            new_fh = os.open(disk_fn, flags)
+            os.dup2(new_fh, fh)
+            os.close(new_fh)
+            os.lseek(fh, offset, os.SEEK_SET)
+        os.chmod(disk_fn, mode)
+        print("moved mirror "+mem_fn+" -> "+disk_fn)
+
+        self.sizes[disk_fn] = self.sizes.pop(mem_fn)
+        self.handles[disk_fn] = self.handles.pop(mem_fn)
+        os.close(self.memfds.pop(mem_fn))
+        return disk_fn
+
+    #===========================================================================
+    def remove(self, tmp_fn):
+        with self.lock:
+            self.sizes.pop(tmp_fn)
+            self.handles.pop(tmp_fn)
+            if tmp_fn in self.memfds:
+                os.close(self.memfds.pop(tmp_fn))
+            else:
+                os.remove(tmp_fn)
+
 #===============================================================================
 class WikiFS(LoggingMixIn, Operations):
-    def __init__(self, local_root, server_url, auth_token):
+    def __init__(self, local_root, server_url, auth_token, store):
         self.local_root = local_root
         assert(not server_url.endswith("/"))
         self.server_url = server_url
         self.auth_token = auth_token
+        self.store = store
         self.rwlock = Lock()
         self.mirror = {}
         self.errors = {}
@@ -93,29 +226,37 @@ class WikiFS(LoggingMixIn, Operations):
             return self._full_path(path)
 
         with self.rwlock:
+            answer = self._request("download", path)
+            content = b64decode(answer['content'].encode("utf-8"))
+
             # create new mirror if needed
             if path not in self.mirror.keys():
-                tmp_f, tmp_fn = tempfile.mkstemp()
-                os.close(tmp_f)
+                tmp_fn = self.store.new(len(content))
                 print("new mirror "+tmp_fn + "  -> "+path)
                 self.mirror[path] = {'tmp_fn':tmp_fn, 'mtime':None, 'size':0, 'refs':0}
 
             # update mirror
             entry = self.mirror[path]
-            tmp_fn = entry['tmp_fn']
-            answer = self._request("download", path)
             if entry['mtime']==None or answer['lock_is_yours']==False:
                 # update file content and mode
+                tmp_fn = self.store.resize(entry['tmp_fn'], len(content))
+                entry['tmp_fn'] = tmp_fn
                 os.chmod(tmp_fn, 0o100664) # '-rw-rw-r--'
-                content = b64decode(answer['content'].encode("utf-8"))
                 open(tmp_fn, "wb").write(content)
                 os.chmod(tmp_fn, answer['st_mode'])
-                st = os.lstat(tmp_fn)
+                st = os.stat(tmp_fn)
                 entry['mtime'] = st.st_mtime
                 entry['size'] = st.st_size
 
             entry['refs'] += 1
-            return tmp_fn
+            return entry['tmp_fn']
+
+    #===========================================================================
+    def _resize_mirror(self, path, size):
+        with self.rwlock:
+            entry = self.mirror[path]
+            entry['tmp_fn'] = self.store.resize(entry['tmp_fn'], size)
+            return entry['tmp_fn']
 
     #===========================================================================
     def _release_mirror(self, path):
@@ -126,14 +267,14 @@ class WikiFS(LoggingMixIn, Operations):
             # check for changes
             entry = self.mirror[path]
             tmp_fn = entry['tmp_fn']
-            st = os.lstat(tmp_fn)
+            st = os.stat(tmp_fn)
             is_dirty = st.st_mtime!=entry['mtime'] or st.st_size!=entry['size']
 
             # upload file content, if needed
             if is_dirty:
                 content = open(tmp_fn, "rb").read()
                 self._request("upload", path, json={"content":b64encode(content).decode("utf-8")})
-                entry['mtime'] = os.lstat(tmp_fn).st_mtime
+                entry['mtime'] = os.stat(tmp_fn).st_mtime
                 # The server may ignore the update.
                 # This will get corrected upon the next _mirror_path() call.
 
@@ -141,7 +282,7 @@ class WikiFS(LoggingMixIn, Operations):
             entry['refs'] -= 1
             if entry['refs'] == 0:
                 self.mirror.pop(path)
-                os.remove(entry['tmp_fn'])
+                self.store.remove(entry['tmp_fn'])
 
     #===========================================================================
     #https://www.cs.hmc.edu/~geoff/classes/hmc.cs135.201001/homework/fuse/fuse_doc.html
@@ -210,7 +351,7 @@ class WikiFS(LoggingMixIn, Operations):
             #TODO currently uses two http calls
             self._request("create", path)
             mirror_path = self._mirror_path(path)
-            return os.open(mirror_path, os.O_WRONLY | os.O_TRUNC)
+            return self.store.open(mirror_path, os.O_WRONLY | os.O_TRUNC)
         else:
             full_path = self._full_path(path)
             return os.open(full_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
@@ -226,18 +367,27 @@ class WikiFS(LoggingMixIn, Operations):
     #===========================================================================
     def open(self, path, flags):
         mirror_path = self._mirror_path(path)
+        if self._is_wiki(path):
+            return self.store.open(mirror_path, flags)
         return os.open(mirror_path, flags)
 
     #===========================================================================
     def truncate(self, path, length, fh=None):
         mirror_path = self._mirror_path(path)
-        with open(mirror_path, 'r+') as f:
-            f.truncate(length)
-        self._release_mirror(path)
+        try:
+            if self._is_wiki(path):
+                mirror_path = self._resize_mirror(path, length)
+            with open(mirror_path, 'r+') as f:
+                f.truncate(length)
+        finally:
+            self._release_mirror(path)
 
     #===========================================================================
     def release(self, path, fh):
-        os.close(fh)
+        if self._is_wiki(path):
+            self.store.close(self.mirror[path]['tmp_fn'], fh)
+        else:
+            os.close(fh)
         self._release_mirror(path)
 
     #===========================================================================
@@ -271,12 +421,18 @@ class WikiFS(LoggingMixIn, Operations):
             # then make new_path writable and copy content
             self.chmod(new_path, 0o100664) # '-rw-rw-r--'
             mirror_old = self._mirror_path(old_path)
-            mirror_new = self._mirror_path(new_path)
-            print("copy file "+mirror_old+" -> "+mirror_new)
-            shutil.copyfile(mirror_old, mirror_new)
-            print("got: "+open(mirror_new).read())
-            self._release_mirror(old_path)
-            self._release_mirror(new_path)
+            try:
+                mirror_new = self._mirror_path(new_path)
+                try:
+                    if new_is_wiki:
+                        mirror_new = self._resize_mirror(new_path, os.stat(mirror_old).st_size)
+                    print("copy file "+mirror_old+" -> "+mirror_new)
+                    shutil.copyfile(mirror_old, mirror_new)
+                    print("got: "+open(mirror_new).read())
+                finally:
+                    self._release_mirror(new_path)
+            finally:
+                self._release_mirror(old_path)
 
             # then restore mode and remove old_path
             self.chmod(new_path, mode)
@@ -312,6 +468,9 @@ class WikiFS(LoggingMixIn, Operations):
     #===========================================================================
     def write(self, path, data, offset, fh):
         with self.rwlock:
+            if self._is_wiki(path):
+                entry = self.mirror[path]
+                entry['tmp_fn'] = self.store.grow(entry['tmp_fn'], offset + len(data))
             os.lseek(fh, offset, 0)
             return os.write(fh, data)
 
@@ -337,11 +496,16 @@ if __name__ == '__main__':
     local_root = config['wikifs']["local_root"]
     server_url = config['wikifs']["server_url"]
     auth_token = config['wikifs']["auth_token"]
+    default_mirror_dir = os.path.join(tempfile.gettempdir(), "wikifs_mirrors_%d"%os.getuid())
+    mirror_dir = config['wikifs'].get("mirror_dir", default_mirror_dir)
+    mirror_quota = config['wikifs'].getint("mirror_quota_mb", 1024) * 1024**2
+    mirror_memory_limit = config['wikifs'].getint("mirror_memory_limit_kb", 256) * 1024
     mnt_point = sys.argv[2]
 
     logging.basicConfig(level=logging.DEBUG)
     print
-    fs = WikiFS(local_root=local_root, server_url=server_url, auth_token=auth_token)
+    store = MirrorStore(directory=mirror_dir, quota=mirror_quota, memory_limit=mirror_memory_limit)
+    fs = WikiFS(local_root=local_root, server_url=server_url, auth_token=auth_token, store=store)
     print(mnt_point)
     fuse = FUSE(fs, mnt_point, foreground=True)
 
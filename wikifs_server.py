@@ -2,13 +2,20 @@
 
 import os
 import json
+import time
+import sqlite3
+import tempfile
 import subprocess
+from threading import Lock
 from functools import wraps
 from base64 import b64encode, b64decode
 from flask import Flask, current_app, Blueprint, request, abort
+from werkzeug.exceptions import HTTPException
 
 wikifs_blueprint = Blueprint('wikifs_server', __name__)
 userdb = None
+lock_cache = {}
+search_lock = Lock()
 
 #===============================================================================
 def wikifs_root():
@@ -84,6 +91,70 @@ def api_chmod():
 
     #TODO handle executable bit properly (might require a commit)
 
+#===============================================================================
+@wikifs_blueprint.route('/batch', methods=['POST'])
+@token_required
+def api_batch():
+    actions = request.get_json()['actions']
+
+    # validate everything before touching any lock
+    for item in actions:
+        if item['action'] not in ("aquire_lock", "release_lock", "status"):
+            abort(400, "Unknown action "+item['action']) # Bad Request
+        if not os.path.basename(item['path']).startswith("_"):
+            abort(400, "File %s is not a wiki page."%item['path']) # Bad Request
+        if not os.path.exists(to_full_path(item['path'])):
+            abort(404, "File %s does not exist."%item['path']) # Not Found
+
+    # All or nothing: on failure newly aquired locks are released again.
+    # Publishing is deferred, such that all pages go into a single git commit.
+    results = [{'path': item['path'], 'action': item['action'], 'success': True, 'message': ""}
+               for item in actions]
+    new_locks = []
+    to_publish = []
+    failed = None
+    try:
+        for item, result in zip(actions, results):
+            failed = result
+            path = item['path']
+            if item['action'] == "aquire_lock" and not user_has_lock(path):
+                aquire_lock(path)
+                new_locks.append(path)
+            elif item['action'] == "release_lock" and user_has_lock(path):
+                to_publish.append(path)
+        failed = None
+        git_commit_files(to_publish)
+    except HTTPException as e:
+        for path in new_locks:
+            release_lock(path)
+        for result in results:
+            result.update(success=False, message="Batch aborted.")
+        if failed:
+            failed.update(message=e.description)
+    except:
+        for path in new_locks:
+            release_lock(path)
+        raise
+    else:
+        for path in to_publish:
+            release_lock(path)
+
+    for result in results:
+        result.update(lock_status(result['path']))
+
+    return json.dumps(results)
+
+#===============================================================================
+@wikifs_blueprint.route('/lockstatus')
+@token_required
+def api_lockstatus():
+    path = request.args["path"]
+    answer = {}
+    for fn, username in dir_locks(path).items():
+        lock_is_yours = username == current_user['username']
+        answer[fn] = {'locked_by': username, 'lock_is_yours': lock_is_yours}
+    return json.dumps(answer)
+
 #===============================================================================
 @wikifs_blueprint.route('/create')
 @token_required
@@ -194,6 +265,32 @@ def api_upload():
 
     return(json.dumps({}))
 
+#===============================================================================
+@wikifs_blueprint.route('/search')
+@token_required
+def api_search():
+    query = request.args["q"]
+    try:
+        limit = int(request.args.get("limit", 50))
+    except ValueError:
+        abort(400, "Invalid limit.") # Bad Request
+    limit = min(max(limit, 1), 500)
+
+    # quote every term, so user input can not break the FTS query syntax
+    terms = ['"'+t.replace('"', '""')+'"' for t in query.split()]
+    if not terms:
+        return json.dumps([])
+
+    db = search_db()
+    try:
+        rows = db.execute("SELECT path, snippet(pages, 1, '[', ']', '...', 10) FROM pages"
+                          " WHERE pages MATCH ? ORDER BY rank LIMIT ?", (" ".join(terms), limit))
+        answer = [{'path': path, 'snippet': snippet} for path, snippet in rows]
+    finally:
+        db.close()
+
+    return json.dumps(answer)
+
 #===============================================================================
 def to_lock_path(path):
     full_path = to_full_path(path)
@@ -204,12 +301,44 @@ def to_lock_path(path):
     return lock_fn
 
 #===============================================================================
-def user_has_lock(path):
+def lock_owner(path):
     lock_path = to_lock_path(path)
     if not os.path.exists(lock_path):
-        return False
-    lock_user = open(lock_path).read().strip()
-    return lock_user == current_user['username']
+        return None
+    return open(lock_path).read().strip()
+
+#===============================================================================
+def user_has_lock(path):
+    return lock_owner(path) == current_user['username']
+
+#===============================================================================
+def lock_status(path):
+    username = lock_owner(path)
+    return {'locked_by': username, 'lock_is_yours': username == current_user['username']}
+
+#===============================================================================
+def dir_locks(path):
+    full_path = to_full_path(path)
+    if not os.path.isdir(full_path):
+        return {}
+
+    # Lock files appear atomically with their content and are never modified.
+    # Hence, the directory's mtime tells when the cached entry is stale.
+    mtime = os.stat(full_path).st_mtime_ns
+    cached = lock_cache.get(full_path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    locks = {}
+    for fn in os.listdir(full_path):
+        if fn.startswith("LOCK_"):
+            username = open(os.path.join(full_path, fn)).read().strip()
+            locks["_"+fn[5:]] = username
+
+    # A recent mtime might not yet reflect all changes, due to its coarse resolution.
+    if time.time_ns() - mtime > 10**9:
+        lock_cache[full_path] = (mtime, locks)
+    return locks
 
 #===============================================================================
 def aquire_lock(path):
@@ -228,10 +357,17 @@ def aquire_lock(path):
     if not os.path.exists(d):
         os.makedirs(d)
 
-    # create new lock
-    f = open(lock_path, "w")
-    f.write(current_user['username']+"\n")
-    f.close()
+    # create new lock atomically, i.e. it never appears without its content
+    tmp_f, tmp_fn = tempfile.mkstemp(prefix=".tmplock_", dir=d)
+    try:
+        os.write(tmp_f, (current_user['username']+"\n").encode("utf-8"))
+        os.close(tmp_f)
+        os.link(tmp_fn, lock_path)
+    except FileExistsError:
+        username = open(lock_path).read().strip()
+        abort(410, "File %s already locked by user %s."%(path, username)) # Gone
+    finally:
+        os.remove(tmp_fn)
 
 #===============================================================================
 def release_lock(path):
@@ -241,25 +377,43 @@ def release_lock(path):
 
 #===============================================================================
 def git_commit_file(path):
-    full_path = to_full_path(path)
-    if not os.path.exists(full_path):
+    git_commit_files([path])
+
+#===============================================================================
+def git_commit_files(paths):
+    # find files which need a commit
+    changes = []
+    for path in paths:
+        full_path = to_full_path(path)
+        if not os.path.exists(full_path):
+            continue
+        if git_file_tracked(path):
+            cmd = ["git", "diff-index", "--quiet", "HEAD", full_path]
+            has_changed = subprocess.call(cmd, cwd=wikifs_root())
+            if has_changed != 0:
+                changes.append((path, "Edit "+path))
+        else:
+            changes.append((path, "New "+path))
+
+    if not changes:
         return
 
-    # make a git commit, if needed
-    commit_msg = None
-    if git_file_tracked(path):
-        cmd = ["git", "diff-index", "--quiet", "HEAD", full_path]
-        has_changed = subprocess.call(cmd, cwd=wikifs_root())
-        if has_changed != 0:
-            commit_msg = "Edit "+path
+    # make a single git commit for all of them
+    if len(changes) == 1:
+        commit_msg = changes[0][1]
     else:
-         commit_msg = "New "+path
+        commit_msg = "Publish %d pages\n\n"%len(changes) + "\n".join(m for p, m in changes)
 
-    if commit_msg:
-        author = ('--author="'+current_user['git_author']+'"').encode("utf-8")
-        env = {"GIT_COMMITTER_NAME": "JupyterWiki", "GIT_COMMITTER_EMAIL": "info@jupyterwiki.org"}
-        subprocess.check_call(["git", "add", full_path], cwd=wikifs_root())
+    full_paths = [to_full_path(p) for p, m in changes]
+    author = ('--author="'+current_user['git_author']+'"').encode("utf-8")
+    env = {"GIT_COMMITTER_NAME": "JupyterWiki", "GIT_COMMITTER_EMAIL": "info@jupyterwiki.org"}
+    subprocess.check_call(["git", "add"] + full_paths, cwd=wikifs_root())
+    try:
         subprocess.check_call(["git", "commit", author, "-m", commit_msg], cwd=wikifs_root(), env=env)
+    except subprocess.CalledProcessError:
+        subprocess.call(["git", "reset", "-q", "HEAD", "--"] + full_paths, cwd=wikifs_root())
+        raise
+    search_index_update()
 
 #===============================================================================
 def git_file_tracked(path):
@@ -278,6 +432,7 @@ def git_remove_file(path):
         env = {"GIT_COMMITTER_NAME": "JupyterWiki", "GIT_COMMITTER_EMAIL": "info@jupyterwiki.org"}
         subprocess.check_call(["git", "rm", "-f", full_path], cwd=wikifs_root())
         subprocess.check_call(["git", "commit", author, "-m", commit_msg], cwd=wikifs_root(), env=env)
+        search_index_update()
     else:
         os.remove(full_path)
 
@@ -291,10 +446,128 @@ def git_rename_file(old_path, new_path):
         env = {"GIT_COMMITTER_NAME": "JupyterWiki", "GIT_COMMITTER_EMAIL": "info@jupyterwiki.org"}
         subprocess.check_call(["git", "mv", "-f", old_full_path, new_full_path], cwd=wikifs_root())
         subprocess.check_call(["git", "commit", author, "-m", commit_msg], cwd=wikifs_root(), env=env)
+        search_index_update()
     else:
         print("rename: "+old_full_path + " -> "+new_full_path)
         os.rename(old_full_path, new_full_path)
 
+#===============================================================================
+# Full-text search index over all published (i.e. git tracked) wiki pages.
+# It remembers the indexed commit and catches up with HEAD via git diff,
+# hence it also picks up commits which were not made through this server.
+#===============================================================================
+def search_db():
+    db_fn = current_app.config.get('WIKIFS_SEARCH_DB')
+    if not db_fn:
+        # keep the index out of the working tree
+        cmd = ["git", "rev-parse", "--git-dir"]
+        git_dir = subprocess.check_output(cmd, cwd=wikifs_root()).decode("utf-8").strip()
+        db_fn = os.path.join(wikifs_root(), git_dir, "wikifs_search.db")
+
+    db = sqlite3.connect(db_fn, timeout=60)
+    try:
+        db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS pages USING fts5(path UNINDEXED, content)")
+        db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        search_index_sync(db)
+    except:
+        # never leave a write transaction open, it would block everyone else
+        db.rollback()
+        db.close()
+        raise
+    return db
+
+#===============================================================================
+def search_index_sync(db=None):
+    if db is None:
+        search_db().close() # opening the index syncs it
+        return
+
+    with search_lock:
+        head = git_head()
+        row = db.execute("SELECT value FROM meta WHERE key='head'").fetchone()
+        indexed = row[0] if row else None
+        if head == indexed:
+            return
+
+        changes = None
+        if indexed and head:
+            cmd = ["git", "diff", "--name-status", "--no-renames", "-z", indexed, head]
+            try:
+                output = subprocess.check_output(cmd, stderr=subprocess.DEVNULL, cwd=wikifs_root())
+                fields = output.decode("utf-8").split("\0")[:-1]
+                changes = list(zip(fields[0::2], fields[1::2]))
+            except subprocess.CalledProcessError:
+                pass # indexed commit is gone, e.g. after a history rewrite
+
+        if changes is None:
+            print("building search index for: "+wikifs_root())
+            db.execute("DELETE FROM pages")
+            changes = [("A", fn) for fn in git_ls_files(head)]
+
+        for status, fn in changes:
+            path = "/" + fn
+            db.execute("DELETE FROM pages WHERE path=?", (path,))
+            if status != "D" and os.path.basename(fn).startswith("_"):
+                content = git_show(head, fn)
+                db.execute("INSERT INTO pages VALUES (?, ?)", (path, page_text(path, content)))
+
+        db.execute("INSERT OR REPLACE INTO meta VALUES ('head', ?)", (head,))
+        db.commit()
+
+#===============================================================================
+def search_index_update():
+    # The commit already happened, hence a broken index must not fail it.
+    try:
+        search_index_sync()
+    except Exception as e:
+        print("updating search index failed: "+repr(e))
+
+#===============================================================================
+def git_head():
+    cmd = ["git", "rev-parse", "--verify", "-q", "HEAD"]
+    try:
+        return subprocess.check_output(cmd, cwd=wikifs_root()).decode("utf-8").strip()
+    except subprocess.CalledProcessError:
+        return None # no commits yet
+
+#===============================================================================
+def git_ls_files(commit):
+    if not commit:
+        return []
+    cmd = ["git", "ls-tree", "-r", "--name-only", "-z", commit]
+    output = subprocess.check_output(cmd, cwd=wikifs_root())
+    return output.decode("utf-8").split("\0")[:-1]
+
+#===============================================================================
+def git_show(commit, fn):
+    # index the published version, not uncommitted edits of locked pages
+    cmd = ["git", "show", commit+":"+fn]
+    return subprocess.check_output(cmd, cwd=wikifs_root())
+
+#===============================================================================
+def page_text(path, content):
+    content = content.decode("utf-8", errors="replace")
+    if not path.endswith(".ipynb"):
+        return content
+
+    # only index the cells of notebooks, not their json structure and outputs
+    try:
+        nb = json.loads(content)
+    except ValueError:
+        return content
+    if not isinstance(nb, dict) or not isinstance(nb.get('cells', []), list):
+        return content # not a notebook after all
+
+    sources = []
+    for c in nb.get('cells', []):
+        s = c.get('source', "") if isinstance(c, dict) else None
+        if isinstance(s, list) and all(isinstance(line, str) for line in s):
+            s = "".join(s)
+        if not isinstance(s, str):
+            return content
+        sources.append(s)
+    return "\n".join(sources)
+
 #===============================================================================
 if __name__ == "__main__":
     import sys
@@ -305,6 +578,8 @@ if __name__ == "__main__":
     app = Flask(__name__)
     app.register_blueprint(wikifs_blueprint, url_prefix='/wikifs')
     app.config['WIKIFS_ROOT'] = os.path.realpath(sys.argv[1])
+    with app.app_context():
+        search_index_sync() # build index upfront, not within the first request
     app.run(port=5002, debug=True)
 
 #EOF